@@ -2,7 +2,10 @@ import logging
 import time
 from datetime import datetime
 from logging import Logger
+from queue import Empty, Full, Queue
+from threading import RLock, Thread
 
+import requests
 from pushbullet import Pushbullet
 from slacker import Slacker
 from trading_bots.bots import Bot
@@ -11,33 +14,122 @@ from trading_bots.contrib.clients import Market, Side
 from trading_bots.contrib.clients import buda
 from trading_bots.utils import truncate_to
 
+# Shared across runs so Slack posts from a warm process reuse the connection
+_slack_session = requests.Session()
+
 
 class Notifier:
+    queue_size = 1024
+    flush_timeout = 10  # Seconds
 
     def __init__(self, tag: str, logger: Logger=None):
         self.config = settings.slack
         self.tag = tag
-        self.slack = Slacker(settings.credentials['Slack']['key'])
+        self.slack = Slacker(settings.credentials['Slack']['key'], session=_slack_session)
         self.pb = Pushbullet(settings.credentials['Pushbullet']['key'])
         self.log = logger or logging.getLogger('Notifier')
+        # Notifications are sent from a background thread so the bot never waits on them
+        self.queue = Queue(maxsize=self.queue_size)
+        self.worker = Thread(target=self._worker, name='Notifier', daemon=True)
+        self.worker.start()
 
     def notify(self, message: str):
+        self._put(message)
+
+    def close(self, timeout: float=None):
+        # Stop the worker once queued notifications are sent, or after timeout
+        timeout = self.flush_timeout if timeout is None else timeout
+        self._put(None)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            self.log.warning(f'Notify close timed out with {self.queue.qsize()} messages pending')
+
+    def _put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                # Drop oldest so a notification outage cannot backlog the bot
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.log.warning(f'Notify dropped: {dropped}')
+                except Empty:
+                    pass
+
+    def _worker(self):
+        while True:
+            # Send everything queued so far as a single batch, None signals the worker to stop
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            messages = [message for message in batch if message is not None]
+            if messages:
+                self._send(messages)
+            if len(messages) < len(batch):
+                return
+
+    def _send(self, messages: list):
+        # Timestamp is formatted once per batch
         t = time.strftime('%Y-%m-%d %H:%M:%S %z', time.localtime())
         tag = f'[{t} {self.tag}]'
+        body = '\n'.join(messages)
         try:
             self.slack.chat.post_message(
                 channel=self.config['channel'],
                 username=self.config['username'],
-                text=f'{tag} {message}',
+                text='\n'.join(f'{tag} {message}' for message in messages),
                 parse='full'
             )
-            self.pb.push_note(title=tag, body=message)
+            self.pb.push_note(title=tag, body=body)
         except Exception:
-            self.log.warning(f'Notify failed: {tag} {message}')
+            self.log.warning(f'Notify failed: {tag} {body}')
+
+
+class Deposit:
+    __slots__ = ('state', 'original_amount', 'converted_amount', 'converted_value', 'orders', 'pending_withdrawal',
+                 'pending_order')
+
+    def __init__(self, state: str, original_amount: float, converted_amount: float=0, converted_value: float=0,
+                 orders: list=None, pending_withdrawal: bool=True, pending_order: int=None):
+        self.state = state
+        self.original_amount = original_amount
+        self.converted_amount = converted_amount
+        self.converted_value = converted_value
+        self.orders = orders if orders is not None else []
+        self.pending_withdrawal = pending_withdrawal
+        self.pending_order = pending_order  # Placed order not yet seen traded
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        amounts = data['amounts']
+        return cls(data['state'], amounts['original_amount'], amounts['converted_amount'],
+                   amounts['converted_value'], data['orders'], data['pending_withdrawal'], data.get('pending_order'))
+
+    def to_dict(self):
+        # Same structure stored by previous versions of the bot
+        return {
+            'state': self.state,
+            'amounts': {'original_amount': self.original_amount,
+                        'converted_amount': self.converted_amount,
+                        'converted_value': self.converted_value},
+            'orders': self.orders,
+            'pending_withdrawal': self.pending_withdrawal,
+            'pending_order': self.pending_order,
+        }
 
 
 class AnyToAny(Bot):
     label = 'AnyToAny'
+    order_final_states = ('traded', 'canceled')
+    # Buda markets rarely change, share them across bot instances
+    markets_ttl = 3600  # Seconds
+    _markets = None
+    _markets_expiry = 0
+    _markets_lock = RLock()
 
     def _setup(self, config):
         # Get configs
@@ -50,43 +142,76 @@ class AnyToAny(Bot):
         self.market = self._get_market(self.from_currency, self.to_currency)
         # Set side
         self.side = Side.SELL if self.market.base == self.from_currency else Side.BUY
+        # Set order amount getters according to side
+        if self.side == Side.BUY:
+            self._amount_from_order = lambda order: order.total_exchanged.amount
+            self._value_from_order = lambda order: order.traded_amount.amount
+        else:
+            self._amount_from_order = lambda order: order.traded_amount.amount
+            self._value_from_order = lambda order: order.total_exchanged.amount
+        # Max seconds to wait for a market order to reach a final state
+        self.fill_timeout = settings.fill_timeout
         # Set Buda trading client
         host = settings.urls['buda']
         self.buda = buda.BudaTrading(
             self.market, dry_run=self.dry_run, timeout=self.timeout, logger=self.log, store=self.store, host=host)
+        # Set wallets from relevant currencies according to side
+        if self.side == Side.BUY:
+            self.from_wallet, self.to_wallet = self.buda.wallets.quote, self.buda.wallets.base
+        else:
+            self.from_wallet, self.to_wallet = self.buda.wallets.base, self.buda.wallets.quote
         # Get deposits from store
-        self.deposits = self.store.get(self.from_currency + '_deposits') or {}
+        deposits = self.store.get(self.from_currency + '_deposits') or {}
+        self.deposits = {idx: Deposit.from_dict(deposit) for idx, deposit in deposits.items()}
+        self._dirty = False  # Set when deposits change, stored once per run
+        self._index_pending()
         # Set start date
         self.start_date = self.get_start_date()
         # Set notifier client
         self.notifier = Notifier(tag=self.label, logger=self.log)
 
     def _algorithm(self):
-        # Get new deposits
-        self.log.info(f'Checking for new {self.from_currency} deposits')
-        self.update_deposits()
-        # Convert pending amounts
-        self.log.info('Converting pending amounts')
-        self.process_conversions()
-        # Get available balances
-        self.log.info('Processing pending withdrawals')
-        self.process_withdrawals()
+        try:
+            # Get new deposits
+            self.log.info(f'Checking for new {self.from_currency} deposits')
+            self.update_deposits()
+            # Convert pending amounts
+            self.log.info('Converting pending amounts')
+            self.process_conversions()
+            # Get available balances
+            self.log.info('Processing pending withdrawals')
+            self.process_withdrawals()
+        finally:
+            # Store changes once, also keeping progress made before a failure
+            self.store_deposits()
 
     def _abort(self):
         pass
 
+    def _post_exec(self):
+        # Send pending notifications and stop the notifier worker before the run ends
+        self.notifier.close()
+
     def store_deposits(self):
-        self.store.set(self.from_currency + '_deposits', self.deposits)
+        if not self._dirty:
+            return
+        deposits = {idx: deposit.to_dict() for idx, deposit in self.deposits.items()}
+        self.store.set(self.from_currency + '_deposits', deposits)
+        self._dirty = False
+
+    def _index_pending(self):
+        # Keep track of unfinished deposits so processing skips finalized ones,
+        # dicts used as ordered sets so deposits are processed in arrival order
+        self._pending_conversion = dict.fromkeys(
+            idx for idx, deposit in self.deposits.items() if deposit.converted_amount != deposit.original_amount)
+        self._pending_withdrawal = dict.fromkeys(
+            idx for idx, deposit in self.deposits.items() if deposit.pending_withdrawal)
 
     def _add_deposit(self, idx, state, original, pending):
-        self.deposits[idx] = {
-            'state': state,
-            'amounts': {'original_amount': original,
-                        'converted_amount': 0,
-                        'converted_value': 0},
-            'orders': [],
-            'pending_withdrawal': pending,
-        }
+        self.deposits[idx] = Deposit(state, original, pending_withdrawal=pending)
+        self._pending_conversion[idx] = None
+        if pending:
+            self._pending_withdrawal[idx] = None
 
     def get_start_date(self):
         start = self.store.get('start')
@@ -95,39 +220,49 @@ class AnyToAny(Bot):
             self.store.set('start', start)
         return datetime.utcfromtimestamp(start)
 
+    def get_new_deposits(self):
+        # Filter deposits by start date and address in a single pass
+        any_address = self.from_address == 'any'
+        return [d for d in self.from_wallet.get_deposits()
+                if d.created_at >= self.start_date and (any_address or d.data.address == self.from_address)]
+
     def update_deposits(self):
-        # Set wallet from relevant currency according to side
-        from_wallet = self.buda.wallets.quote if self.side == Side.BUY else self.buda.wallets.base
-        # Get and filter deposits
-        new_deposits = from_wallet.get_deposits()
-        if self.from_address != 'any':
-            new_deposits = [d for d in new_deposits if d.data.address == self.from_address]
-        new_deposits = [d for d in new_deposits if d.created_at >= self.start_date]
+        new_deposits = self.get_new_deposits()
         # Update states on existing keys and add new keys with base structure
         for deposit in new_deposits:
             idx = str(deposit.id)
-            if idx in self.deposits.keys():
-                if deposit.state != self.deposits[idx]['state']:
-                    self.deposits[idx]['state'] = deposit.state
-                    self.notifier.notify(f'Deposit {idx} state changed to {deposit.state}')
+            if idx in self.deposits:
+                if deposit.state == self.deposits[idx].state:
+                    continue  # Nothing changed
+                self.deposits[idx].state = deposit.state
+                self.notifier.notify(f'Deposit {idx} state changed to {deposit.state}')
             else:
                 self._add_deposit(idx, deposit.state, deposit.amount.amount, self.to_withdraw)
                 self.notifier.notify(f'New deposit detected: id: {idx} | currency: {deposit.amount.currency} | '
                                      f'amount: {deposit.amount.amount} | state: {deposit.state}')
-            self.store_deposits()
+            self._dirty = True
 
     def process_conversions(self):
-        # Get deposits
-        for deposit in self.deposits.values():
+        # Get deposits pending conversion
+        for idx in list(self._pending_conversion):
+            deposit = self.deposits[idx]
+            if deposit.pending_order is not None:
+                # Order placed by a previous run that did not see it finish, never place a new one meanwhile
+                order = self.buda.client.order_details(deposit.pending_order)
+                if order.state in self.order_final_states:
+                    self._apply_order(idx, order)
+                else:
+                    self.log.info(f'Order {order.id} for deposit {idx} still {order.state}, skipping')
+                continue
             # Calculate remaining amount to convert
-            original_amount = deposit['amounts']['original_amount']
-            converted_amount = deposit['amounts']['converted_amount']
-            converted_value = deposit['amounts']['converted_value']
+            original_amount = deposit.original_amount
+            converted_amount = deposit.converted_amount
             remaining = original_amount - converted_amount
             if converted_amount / original_amount >= 0.99:
-                deposit['amounts']['converted_amount'] = original_amount
-                self.store_deposits()
-            elif deposit['state'] == 'confirmed' and remaining > 0:
+                deposit.converted_amount = original_amount
+                self._pending_conversion.pop(idx, None)
+                self._dirty = True
+            elif deposit.state == 'confirmed' and remaining > 0:
                 if self.side == Side.BUY:  # Change amount to base currency for order creation purposes
                     quotation = self.buda.client.quotation_market(
                         market_id=self.buda.market_id, quotation_type='bid_given_spent_quote', amount=remaining)
@@ -136,48 +271,58 @@ class AnyToAny(Bot):
                 # Convert remaining amount using market order
                 order = self.buda.place_market_order(self.side, remaining)
                 self.notifier.notify(f'{self.side.value}ing {remaining} {self.market.base} at market rate')
-                # Wait for traded state to set updated values
+                # Wait for final state to set updated values
                 if order:
-                    self.log.info(f'{self.side} market order placed, waiting for traded state')
-                    while order.state != 'traded':
-                        order = self.buda.client.order_details(order.id)
-                        time.sleep(1)
-                    self.log.info(f'{self.side} order traded, updating store values')
-                    # Update amounts
-                    if self.side == Side.BUY and order.state == 'traded':
-                        converted_amount += order.total_exchanged.amount
-                        converted_value += order.traded_amount.amount
-                    else:
-                        converted_amount += order.traded_amount.amount
-                        converted_value += order.total_exchanged.amount
-                    converted_value -= order.paid_fee.amount  # Fee deducted so it wont interfere with withdrawal
-                    deposit['orders'].append(order.id)  # Save related orders for debugging
-                    self.notifier.notify(f'Success!, converted value: {converted_value} {self.to_currency}')
-                # Save new values
-                deposit['amounts']['converted_amount'] = converted_amount
-                deposit['amounts']['converted_value'] = converted_value
-                self.store_deposits()
+                    # Store order before waiting so a timeout or crash cannot lose it
+                    deposit.orders.append(order.id)
+                    deposit.pending_order = order.id
+                    self._dirty = True
+                    self.store_deposits()
+                    self.log.info(f'{self.side} market order placed, waiting for final state')
+                    order = self.wait_for_order(order)
+                    if order is None:
+                        continue  # Pending order is reconciled on a later run
+                    self.log.info(f'{self.side} order {order.state}, updating store values')
+                    self._apply_order(idx, order)
+
+    def _apply_order(self, idx, order):
+        deposit = self.deposits[idx]
+        # Update amounts, fee deducted from value so it wont interfere with withdrawal
+        deposit.converted_amount += self._amount_from_order(order)
+        deposit.converted_value += self._value_from_order(order) - order.paid_fee.amount
+        deposit.pending_order = None
+        if deposit.converted_amount == deposit.original_amount:
+            self._pending_conversion.pop(idx, None)
+        self._dirty = True
+        self.notifier.notify(f'Order {order.id} {order.state}, converted value: {deposit.converted_value} '
+                             f'{self.to_currency}')
 
     def process_withdrawals(self):
-        # Set wallet from relevant currency according to side
-        to_wallet = self.buda.wallets.base if self.side == Side.BUY else self.buda.wallets.quote
-        for deposit in self.deposits.values():
-            # Filter deposits already converted and pending withdrawal
-            deposit_confirmed = deposit['state'] == 'confirmed'
-            has_pending_withdrawal = deposit['pending_withdrawal']
-            converted_all = deposit['amounts']['original_amount'] == deposit['amounts']['converted_amount']
-            if deposit_confirmed and has_pending_withdrawal and converted_all:
-                withdrawal_amount = truncate_to(deposit['amounts']['converted_value'], self.to_currency)
-                available = to_wallet.get_available()
+        available = None  # Balance fetched once when first needed, then tracked locally
+        for idx in list(self._pending_withdrawal):
+            deposit = self.deposits[idx]
+            # Filter deposits already converted
+            deposit_confirmed = deposit.state == 'confirmed'
+            converted_all = idx not in self._pending_conversion
+            if deposit_confirmed and converted_all:
+                withdrawal_amount = truncate_to(deposit.converted_value, self.to_currency)
+                if available is None:
+                    available = self.to_wallet.get_available()
                 if withdrawal_amount <= available:  # We cannot withdraw more than available balance
                     self.notifier.notify(f'Withdrawing {withdrawal_amount} {self.to_currency}')
-                    withdrawal = to_wallet.request_withdrawal(withdrawal_amount, self.to_address, subtract_fee=True)
+                    withdrawal = self.to_wallet.request_withdrawal(
+                        withdrawal_amount, self.to_address, subtract_fee=True)
                     if withdrawal.state == 'pending_preparation':  # Check state to set and store updated values
                         self.log.info(f'{self.to_currency} withdrawal request received, updating store values')
-                        deposit['pending_withdrawal'] = False
-                        self.store.set(self.from_currency + '_deposits', self.deposits)
+                        available -= withdrawal_amount
+                        deposit.pending_withdrawal = False
+                        self._pending_withdrawal.pop(idx, None)
+                        # Store right away, a withdrawal cannot be undone if the run is killed later
+                        self._dirty = True
+                        self.store_deposits()
                         self.notifier.notify(f'Success!, withdrawal id: {withdrawal.id}')
                     else:
+                        available = None  # Unexpected state, refresh balance before next withdrawal
                         msg = 'Withdrawal failed'
                         self.log.warning(msg)
                         self.notifier.notify(f'{msg}, :shame:')
@@ -186,15 +331,34 @@ class AnyToAny(Bot):
                     self.log.warning(msg)
                     self.notifier.notify(msg)
 
-    def _get_market(self, from_currency, to_currency):
-        public_client = buda.BudaPublic()
-        buda_markets = public_client.client.markets()
-        bases = [market.base_currency for market in buda_markets]
-        quotes = [market.quote_currency for market in buda_markets]
-        if from_currency in bases and to_currency in quotes:
-            market = Market((from_currency, to_currency))
-        elif from_currency in quotes and to_currency in bases:
-            market = Market((to_currency, from_currency))
-        else:
+    def wait_for_order(self, order):
+        # Poll with exponential backoff, fast fills are detected quickly and slow ones polled less
+        delay = 0.05
+        deadline = time.monotonic() + self.fill_timeout
+        while order.state not in self.order_final_states:
+            if time.monotonic() > deadline:
+                self.log.warning(f'Order {order.id} still {order.state} after {self.fill_timeout} seconds')
+                return None
+            time.sleep(delay)
+            delay = min(delay * 1.7, 2.0)
+            order = self.buda.client.order_details(order.id)
+        return order
+
+    @classmethod
+    def _get_markets(cls):
+        with cls._markets_lock:
+            if cls._markets is None or time.monotonic() >= cls._markets_expiry:
+                public_client = buda.BudaPublic()
+                buda_markets = public_client.client.markets()
+                cls._markets = {(m.base_currency, m.quote_currency): Market((m.base_currency, m.quote_currency))
+                                for m in buda_markets}
+                cls._markets_expiry = time.monotonic() + cls.markets_ttl
+            return cls._markets
+
+    @classmethod
+    def _get_market(cls, from_currency, to_currency):
+        markets = cls._get_markets()
+        market = markets.get((from_currency, to_currency)) or markets.get((to_currency, from_currency))
+        if market is None:
             raise ValueError(f'No compatible market found!')
         return market
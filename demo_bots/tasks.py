@@ -1,9 +1,14 @@
 from trading_bots.bots import BotTask
 
+# Tasks reused across events handled by the same process, keyed by (bot, config)
+_tasks = {}
+
 
 def run_bot(event):
     event_kwargs = event.get('kwargs', {})
     bot = event_kwargs['bot']
     config = event_kwargs.get('config')
-    bot_task = BotTask(bot, config, None)
+    bot_task = _tasks.get((bot, config))
+    if bot_task is None:
+        bot_task = _tasks[(bot, config)] = BotTask(bot, config, None)
     bot_task.run_once()